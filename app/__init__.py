@@ -1,13 +1,19 @@
-from flask import Flask, request, render_template, redirect
+from flask import Flask, request, render_template, redirect, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from flask_wtf.csrf import CSRFProtect
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.proxy_fix import ProxyFix
 from app.config import Config
 import os
+import click
+import atexit
+import queue
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Инициализация расширений Flask
 db = SQLAlchemy()
@@ -15,8 +21,21 @@ migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
 login_manager.login_message = 'Please log in to access this page.'
-login_manager.session_protection = 'strong'
 csrf = CSRFProtect()
+limiter = Limiter(key_func=get_remote_address)
+
+# Endpoints whose hits are logged as security events
+_LOGGED_ENDPOINTS = frozenset({'auth.login', 'auth.register', 'payment.callback'})
+
+# Directories already created by this process (repeated create_app calls skip them)
+_dirs_created = set()
+
+
+def _ensure_dir(path):
+    """Create a directory once per process."""
+    if path not in _dirs_created:
+        os.makedirs(path, exist_ok=True)
+        _dirs_created.add(path)
 
 
 def create_app(config_class=Config):
@@ -27,6 +46,12 @@ def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Behind a reverse proxy remote_addr is the proxy: take the client address from
+    # the trusted X-Forwarded-For hop so per-IP rate limits are not one global bucket
+    proxy_hops = app.config.get('PROXY_FIX_X_FOR', 0)
+    if proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxy_hops)
+
     # Force-safe defaults in production
     if os.environ.get('FLASK_ENV') == 'production':
         app.config['DEBUG'] = False
@@ -36,10 +61,30 @@ def create_app(config_class=Config):
     db.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
+    login_manager.session_protection = app.config.get('SESSION_PROTECTION', 'basic')
     csrf.init_app(app)
-    
-    # Create upload folder
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    limiter.init_app(app)
+    
+    # Create upload and result cache folders
+    _ensure_dir(app.config['UPLOAD_FOLDER'])
+    _ensure_dir(app.config['RESULT_CACHE_FOLDER'])
+    
+    # Background task queues (optional, see CONVERSION_QUEUE_ENABLED / WEBHOOK_QUEUE_ENABLED)
+    if app.config.get('CONVERSION_QUEUE_ENABLED') or app.config.get('WEBHOOK_QUEUE_ENABLED'):
+        from redis import Redis
+        from rq import Queue
+        redis_connection = Redis.from_url(app.config['TASK_QUEUE_URL'])
+        if app.config.get('CONVERSION_QUEUE_ENABLED'):
+            app.extensions['conversion_queue'] = Queue(
+                app.config['CONVERSION_QUEUE_NAME'],
+                connection=redis_connection,
+                default_timeout=app.config['CONVERSION_JOB_TIMEOUT'],
+            )
+        if app.config.get('WEBHOOK_QUEUE_ENABLED'):
+            app.extensions['webhook_queue'] = Queue(
+                app.config['WEBHOOK_QUEUE_NAME'],
+                connection=redis_connection,
+            )
     
     # ===== SECURITY MIDDLEWARE =====
     canonical_base_url = app.config.get('CANONICAL_BASE_URL', '').rstrip('/')
@@ -47,52 +92,70 @@ def create_app(config_class=Config):
     if canonical_base_url:
         canonical_host = canonical_base_url.replace('https://', '').replace('http://', '').split('/')[0].lower()
     force_canonical_redirect = app.config.get('FORCE_CANONICAL_REDIRECT', False)
+    # Snapshot once: the header set does not change after app creation.
+    security_headers = tuple(app.config.get('SECURITY_HEADERS', {}).items())
     
     @app.after_request
     def add_security_headers(response):
         """Add security headers to all responses."""
-        for header, value in app.config.get('SECURITY_HEADERS', {}).items():
-            response.headers[header] = value
+        headers = response.headers
+        for header, value in security_headers:
+            headers[header] = value
         return response
     
-    @app.before_request
-    def log_request_info():
-        """Log security events."""
-        # Enforce one canonical host to prevent duplicate indexing.
-        if force_canonical_redirect and canonical_host and request.method in ['GET', 'HEAD']:
-            request_host = request.host.split(':')[0].lower()
-            is_local_host = request_host in ['localhost', '127.0.0.1', '::1']
-            if request_host != canonical_host and not is_local_host:
+    # Enforce one canonical host to prevent duplicate indexing.
+    # The hook is only registered when redirects are enabled, so the
+    # request path carries no dead branch otherwise.
+    if force_canonical_redirect and canonical_host:
+        local_hosts = frozenset({'localhost', '127.0.0.1', '::1'})
+
+        @app.before_request
+        def redirect_to_canonical_host():
+            """Redirect GET/HEAD requests from mirror hosts to the canonical domain."""
+            if request.method not in ('GET', 'HEAD'):
+                return None
+            request_host = request.host.partition(':')[0].lower()
+            if request_host != canonical_host and request_host not in local_hosts:
                 path = request.full_path if request.query_string else request.path
                 if path.endswith('?'):
                     path = path[:-1]
                 return redirect(f"{canonical_base_url}{path}", code=301)
+            return None
 
-        if request.endpoint in ['auth.login', 'auth.register', 'payment.callback']:
+    @app.before_request
+    def log_request_info():
+        """Log security events."""
+        # Skip the whole branch when INFO records would be dropped anyway
+        if app.logger.isEnabledFor(logging.INFO) and request.endpoint in _LOGGED_ENDPOINTS:
             app.logger.info(
-                f"Security event: {request.endpoint} from IP {request.remote_addr}"
+                "Security event: %s from IP %s", request.endpoint, request.remote_addr
             )
 
+    # Operator details are static config: build the dict once per app.
+    operator_info = {
+        'name': app.config.get('SERVICE_OPERATOR_NAME', ''),
+        'status': app.config.get('SERVICE_OPERATOR_STATUS', ''),
+        'email': app.config.get('SERVICE_OPERATOR_EMAIL', ''),
+        'phone': app.config.get('SERVICE_OPERATOR_PHONE', ''),
+        'address': app.config.get('SERVICE_OPERATOR_ADDRESS', ''),
+        'country': app.config.get('SERVICE_OPERATOR_COUNTRY', ''),
+        'hours': app.config.get('SERVICE_OPERATOR_HOURS', ''),
+        'tax_id': app.config.get('SERVICE_OPERATOR_TAX_ID', ''),
+        'registry_id': app.config.get('SERVICE_OPERATOR_REGISTRY_ID', ''),
+    }
+
     @app.context_processor
     def inject_canonical_url():
-        path = request.path or '/'
-        operator_info = {
-            'name': app.config.get('SERVICE_OPERATOR_NAME', ''),
-            'status': app.config.get('SERVICE_OPERATOR_STATUS', ''),
-            'email': app.config.get('SERVICE_OPERATOR_EMAIL', ''),
-            'phone': app.config.get('SERVICE_OPERATOR_PHONE', ''),
-            'address': app.config.get('SERVICE_OPERATOR_ADDRESS', ''),
-            'country': app.config.get('SERVICE_OPERATOR_COUNTRY', ''),
-            'hours': app.config.get('SERVICE_OPERATOR_HOURS', ''),
-            'tax_id': app.config.get('SERVICE_OPERATOR_TAX_ID', ''),
-            'registry_id': app.config.get('SERVICE_OPERATOR_REGISTRY_ID', ''),
-        }
-        if canonical_base_url:
-            return {
-                'canonical_url': f"{canonical_base_url}{path}",
-                'operator_info': operator_info
-            }
-        return {'canonical_url': request.base_url, 'operator_info': operator_info}
+        # Context processors run on every render_template call;
+        # build the canonical URL at most once per request.
+        canonical_url = g.get('_canonical_url')
+        if canonical_url is None:
+            if canonical_base_url:
+                canonical_url = f"{canonical_base_url}{request.path or '/'}"
+            else:
+                canonical_url = request.base_url
+            g._canonical_url = canonical_url
+        return {'canonical_url': canonical_url, 'operator_info': operator_info}
     
     # ===== BLUEPRINT REGISTRATION =====
     
@@ -137,8 +200,7 @@ def create_app(config_class=Config):
     # ===== LOGGING CONFIGURATION =====
     
     if not app.debug:
-        if not os.path.exists('logs'):
-            os.mkdir('logs')
+        _ensure_dir('logs')
         
         file_handler = RotatingFileHandler(
             'logs/rag_converter.log', 
@@ -149,7 +211,15 @@ def create_app(config_class=Config):
             '%(asctime)s %(levelname)s: %(message)s [%(pathname)s:%(lineno)d]'
         ))
         file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+
+        # Запись в файл и ротация выполняются в фоновом потоке,
+        # запросы только кладут запись в очередь.
+        log_queue = queue.Queue(-1)
+        app.logger.addHandler(QueueHandler(log_queue))
+        listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+        listener.start()
+        app.extensions['log_listener'] = listener
+        atexit.register(listener.stop)
         app.logger.setLevel(logging.INFO)
         app.logger.info('RAG Converter startup')
 
@@ -157,8 +227,20 @@ def create_app(config_class=Config):
         if app.config.get('SECRET_KEY') == 'dev-secret-key-change-me':
             app.logger.warning('SECURITY: SECRET_KEY is default. Set SECRET_KEY in environment.')
     
-    with app.app_context():
+    # ===== CLI COMMANDS =====
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Create database tables (one-shot, instead of on every worker boot)."""
         db.create_all()
+        click.echo('Database tables created.')
+
+    @app.cli.command('purge-result-cache')
+    def purge_result_cache_command():
+        """Delete cached conversion results older than RESULT_CACHE_TTL (run from cron)."""
+        from app.main.routes import purge_result_cache
+        removed = purge_result_cache()
+        click.echo(f'Removed {removed} cached results.')
     
     return app
 
@@ -1,37 +1,21 @@
 import re
-from flask import render_template, redirect, url_for, flash, request
+import hmac
+import string
+from urllib.parse import urlsplit
+from flask import render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_user, logout_user, current_user, login_required
-from app import db
+from sqlalchemy.exc import IntegrityError
+from app import db, limiter
 from app.auth import bp
-from app.models import User, Subscription, UsageCounter
+from app.models import User, Subscription, UsageCounter, hash_password
 
-# Простой rate limiting в памяти для аутентификации
-from datetime import datetime, timedelta
-from collections import defaultdict
+# Регулярное выражение для email (компилируется один раз при импорте)
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
 
-# Хранилище попыток входа по IP адресам
-login_attempts = defaultdict(list)
-RATE_LIMIT_WINDOW = 300  # Окно ограничения: 5 минут
-MAX_LOGIN_ATTEMPTS = 5  # Максимум попыток входа
-
-
-def is_rate_limited(ip_address):
-    """
-    Проверка, заблокирован ли IP адрес из-за превышения лимита попыток.
-    Возвращает True если IP заблокирован.
-    """
-    now = datetime.utcnow()
-    # Очистка старых записей попыток
-    login_attempts[ip_address] = [
-        t for t in login_attempts[ip_address] 
-        if now - t < timedelta(seconds=RATE_LIMIT_WINDOW)
-    ]
-    return len(login_attempts[ip_address]) >= MAX_LOGIN_ATTEMPTS
-
-
-def record_login_attempt(ip_address):
-    """Запись неудачной попытки входа."""
-    login_attempts[ip_address].append(datetime.utcnow())
+# Наборы символов для проверки пароля (проверка isdisjoint выполняется в C)
+_UPPER_CHARS = frozenset(string.ascii_uppercase)
+_LOWER_CHARS = frozenset(string.ascii_lowercase)
+_DIGIT_CHARS = frozenset(string.digits)
 
 
 def validate_email(email):
@@ -39,8 +23,7 @@ def validate_email(email):
     Проверка корректности формата email.
     Возвращает True если формат правильный.
     """
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 
 def validate_password(password):
@@ -56,11 +39,11 @@ def validate_password(password):
     """
     if len(password) < 8:
         return False, 'Password must be at least 8 characters long.'
-    if not re.search(r'[A-Z]', password):
+    if _UPPER_CHARS.isdisjoint(password):
         return False, 'Password must contain at least one uppercase letter.'
-    if not re.search(r'[a-z]', password):
+    if _LOWER_CHARS.isdisjoint(password):
         return False, 'Password must contain at least one lowercase letter.'
-    if not re.search(r'\d', password):
+    if _DIGIT_CHARS.isdisjoint(password):
         return False, 'Password must contain at least one digit.'
     return True, None
 
@@ -71,16 +54,15 @@ def is_safe_redirect_url(target):
     Предотвращает уязвимость Open Redirect.
     
     Разрешены только относительные URL начинающиеся с /
+    Отклоняются, например: '//x', '///x', '////x', '/\\x', 'http://x'.
     """
-    if not target:
-        return False
-    # Разрешаем только относительные URL
-    if not target.startswith('/'):
-        return False
-    # Запрещаем URL с протоколом или доменом
-    if '//' in target or ':' in target.split('/')[0]:
+    if not target or '\\' in target or '//' in target:
+        # Браузеры трактуют обратный слэш как '/', а '///evil.com' - как '//evil.com';
+        # urlsplit такие цели не распознает как чужой домен, поэтому '//' запрещен целиком
         return False
-    return True
+    parsed = urlsplit(target)
+    # Запрещаем URL с протоколом или доменом, разрешаем только абсолютные пути
+    return not parsed.scheme and not parsed.netloc and parsed.path.startswith('/')
 
 
 @bp.route('/register', methods=['GET', 'POST'])
@@ -111,33 +93,35 @@ def register():
             return render_template('auth/register.html')
         
         # Check password match
-        if password != password_confirm:
+        if not hmac.compare_digest(password.encode('utf-8'), password_confirm.encode('utf-8')):
             flash('Passwords do not match.', 'error')
             return render_template('auth/register.html')
         
-        # Check existing user
+        # Check existing user (index-only lookup of the id)
         # Do not reveal if user exists (security)
-        if User.query.filter_by(email=email).first():
+        if db.session.query(User.id).filter_by(email=email).first() is not None:
             flash('Registration failed. Please try a different email.', 'error')
             return render_template('auth/register.html')
         
         try:
-            # Create user
+            # Create user with subscription and usage records.
+            # Related rows are cascaded through the relationships and
+            # written in a single flush on commit.
             user = User(email=email)
             user.set_password(password)
+            user.subscription = Subscription(status='free_tier')
+            user.usage = UsageCounter(free_uses=0)
             db.session.add(user)
-            db.session.flush()  # Get user ID
-            
-            # Create subscription and usage records
-            subscription = Subscription(user_id=user.id, status='free_tier')
-            usage = UsageCounter(user_id=user.id, free_uses=0)
-            db.session.add(subscription)
-            db.session.add(usage)
             db.session.commit()
             
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('auth.login'))
             
+        except IntegrityError:
+            # Concurrent signup with the same email hit the unique constraint
+            db.session.rollback()
+            flash('Registration failed. Please try a different email.', 'error')
+            return render_template('auth/register.html')
         except Exception as e:
             db.session.rollback()  # Rollback on error
             flash('Registration error. Please try again later.', 'error')
@@ -146,7 +130,24 @@ def register():
     return render_template('auth/register.html')
 
 
+def _login_failed(response):
+    """Учитывать в лимите только неудачные попытки входа (успех - редирект)."""
+    return response.status_code != 302
+
+
+@bp.errorhandler(429)
+def too_many_login_attempts(error):
+    """Ответ при превышении лимита попыток входа."""
+    flash('Too many login attempts. Please wait 5 minutes.', 'error')
+    return render_template('auth/login.html'), 429
+
+
 @bp.route('/login', methods=['GET', 'POST'])
+@limiter.limit(
+    lambda: current_app.config['LOGIN_RATE_LIMIT'],
+    methods=['POST'],
+    deduct_when=_login_failed,
+)
 def login():
     """
     Вход в систему.
@@ -158,13 +159,6 @@ def login():
         return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
-        ip_address = request.remote_addr
-        
-        # Rate limiting check
-        if is_rate_limited(ip_address):
-            flash('Too many login attempts. Please wait 5 minutes.', 'error')
-            return render_template('auth/login.html')
-        
         email = request.form.get('email', '').strip().lower()
         password = request.form.get('password', '')
         remember = request.form.get('remember', False)
@@ -176,13 +170,18 @@ def login():
         
         user = User.query.filter_by(email=email).first()
         
-        # Check credentials
+        # Check credentials (argon2-cffi отпускает GIL - хеш проверяется прямо в потоке запроса;
+        # число одновременных проверок ограничено потоками gunicorn)
         if user is None or not user.check_password(password):
-            record_login_attempt(ip_address)  # Record failed attempt
             # Generic error message (do not reveal if user exists)
             flash('Invalid email or password.', 'error')
             return render_template('auth/login.html')
         
+        # Перевод старого хеша на Argon2 (пароль известен только сейчас)
+        if user.password_needs_rehash():
+            user.password_hash = hash_password(password)
+            db.session.commit()
+        
         # Login user
         login_user(user, remember=bool(remember))
         
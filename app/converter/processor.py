@@ -10,10 +10,104 @@
 import os
 import re
 import tempfile
+from functools import lru_cache
 from pypdf import PdfReader
+try:
+    import pymupdf
+except ImportError:  # PyMuPDF не установлен - используется только pypdf
+    pymupdf = None
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
 
+# Регулярные выражения для clean_text (компилируются один раз при импорте).
+# Построчные правила применяются к целому буферу в режиме MULTILINE;
+# [^\S\n] - пробельные символы кроме перевода строки. Lookbehind и
+# possessive-квантификаторы исключают квадратичный перебор на длинных
+# последовательностях пробелов.
+_SOURCE_RE = re.compile(r'^## Источник:.*$', re.MULTILINE)
+_DOTS_RE = re.compile(r'\.{2,}')
+_UNI_RE = re.compile(r'/uni([0-9A-Fa-f]{4})')
+_EDGE_SPACE_RE = re.compile(r'^[^\S\n]++|(?<![^\S\n])[^\S\n]++$', re.MULTILINE)
+_PAGE_NUM_RE = re.compile(r'(?<![^\S\n])[^\S\n]++\d++$', re.MULTILINE)
+_JUNK_LINE_RE = re.compile(r'^(?:[.#]|[^\S\n])*+$', re.MULTILINE)
+_JUNK_HEADER_RE = re.compile(
+    r'^\d+(?:(?:\.|[^\S\n])\d+)*[^\S\n]++(?:[.#]|[^\S\n])++$', re.MULTILINE
+)
+_HEADER_RE = re.compile(r'^\d+(?:(?:\.|[^\S\n])\d+)*[^\S\n]++(.*)$', re.MULTILINE)
+_BLANK_LINES_RE = re.compile(r'\n{2,}')
+# Запасная нормализация текста, если после очистки ничего не осталось
+_WS_RE = re.compile(r'\s+')
+
+# Формат записей чанков в dataset.md
+CHUNK_HEADER = "## Источник: "
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+
+def _join_pages(parts):
+    """Склейка текста страниц одним join (без квадратичной конкатенации строк)."""
+    if not parts:
+        return ""
+    return "\n".join(parts) + "\n"
+
+
+def _append_page(parts, page_text, total, max_text_chars):
+    """
+    Добавление текста страницы с учетом лимита символов.
+    Прерывает извлечение сразу, как только лимит превышен,
+    не дочитывая оставшиеся страницы.
+    
+    Returns:
+        int: Накопленное число символов
+    """
+    parts.append(page_text)
+    total += len(page_text) + 1
+    if max_text_chars and total > max_text_chars:
+        raise ValueError("PDF слишком большой (слишком много текста).")
+    return total
+
+
+def _read_pdf_pymupdf(filepath, max_pdf_pages=None, max_text_chars=None):
+    """Извлечение текста PDF через PyMuPDF (MuPDF, C)."""
+    parts = []
+    total = 0
+    with pymupdf.open(filepath) as doc:
+        if max_pdf_pages and doc.page_count > max_pdf_pages:
+            raise ValueError("PDF слишком большой (слишком много страниц).")
+        for page in doc:
+            page_text = page.get_text("text")
+            if page_text:
+                total = _append_page(parts, page_text, total, max_text_chars)
+    return _join_pages(parts)
+
+
+def _read_pdf_pypdf(filepath, max_pdf_pages=None, max_text_chars=None):
+    """Извлечение текста PDF через pypdf (чистый Python, запасной вариант)."""
+    parts = []
+    total = 0
+    reader = PdfReader(filepath)
+    if max_pdf_pages and len(reader.pages) > max_pdf_pages:
+        raise ValueError("PDF слишком большой (слишком много страниц).")
+    for page in reader.pages:
+        page_text = page.extract_text()
+        if page_text:
+            total = _append_page(parts, page_text, total, max_text_chars)
+    return _join_pages(parts)
+
+
+def _read_pdf(filepath, max_pdf_pages=None, max_text_chars=None):
+    """
+    Извлечение текста из PDF.
+    Основной движок - PyMuPDF (в разы быстрее pypdf); pypdf используется,
+    если PyMuPDF не установлен или не смог разобрать файл.
+    """
+    if pymupdf is not None:
+        try:
+            return _read_pdf_pymupdf(filepath, max_pdf_pages=max_pdf_pages, max_text_chars=max_text_chars)
+        except pymupdf.FileDataError:
+            pass
+    return _read_pdf_pypdf(filepath, max_pdf_pages=max_pdf_pages, max_text_chars=max_text_chars)
+
+
 def read_file(filepath, max_pdf_pages=None, max_text_chars=None):
     """
     Читает содержимое файла .txt или .pdf.
@@ -52,13 +146,7 @@ def read_file(filepath, max_pdf_pages=None, max_text_chars=None):
                         text = f.read()
         elif filename.lower().endswith(".pdf"):
             # Извлечение текста из всех страниц PDF
-            reader = PdfReader(filepath)
-            if max_pdf_pages and len(reader.pages) > max_pdf_pages:
-                raise ValueError("PDF слишком большой (слишком много страниц).")
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+            text = _read_pdf(filepath, max_pdf_pages=max_pdf_pages, max_text_chars=max_text_chars)
             if not text.strip():
                 raise ValueError(
                     "В PDF не найден извлекаемый текст. "
@@ -74,6 +162,14 @@ def read_file(filepath, max_pdf_pages=None, max_text_chars=None):
     return text
 
 
+def _replace_uni(match):
+    """Замена последовательности /uniXXXX на соответствующий Unicode символ."""
+    try:
+        return chr(int(match.group(1), 16))
+    except ValueError:
+        return match.group(0)
+
+
 def clean_text(text):
     """
     Очищает текст по расширенным правилам:
@@ -94,53 +190,41 @@ def clean_text(text):
         return ""
 
     # Удаление строк источника (если есть во входных данных)
-    text = re.sub(r'^## Источник:.*$', '', text, flags=re.MULTILINE)
+    text = _SOURCE_RE.sub('', text)
     
     # Удаление последовательностей из двух и более точек
-    text = re.sub(r'\.{2,}', '', text)
+    text = _DOTS_RE.sub('', text)
     
     # Исправление кодировки (замена /uniXXXX на Unicode символы)
-    def replace_uni(match):
-        try:
-            return chr(int(match.group(1), 16))
-        except:
-            return match.group(0)
-    text = re.sub(r'/uni([0-9A-Fa-f]{4})', replace_uni, text)
+    text = _UNI_RE.sub(_replace_uni, text)
     
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
-        # Удаление ведущих и завершающих пробелов
-        stripped_line = line.strip()
-        
-        # Пропуск пустых строк
-        if not stripped_line:
-            continue
+    # Удаление ведущих и завершающих пробелов в каждой строке
+    text = _EDGE_SPACE_RE.sub('', text)
 
-        # Удаление номеров страниц в конце строки (например, " 123")
-        stripped_line = re.sub(r'\s+\d+$', '', stripped_line).strip()
-        
-        if not stripped_line:
-            continue
-            
-        # Удаление мусорных строк (только точки, решетки или пробелы)
-        if re.match(r'^[\.#\s]+$', stripped_line):
-            continue
+    # Удаление номеров страниц в конце строк (например, " 123")
+    text = _PAGE_NUM_RE.sub('', text)
 
-        # Форматирование заголовков вида "1.2 Название" -> "# Название"
-        match_header = re.match(r'^(\d+(?:[\.\s]\d+)*)\s+(.*)$', stripped_line)
-        if match_header:
-            content = match_header.group(2)
-            # Проверка что после цифр есть осмысленный текст
-            if content.strip() and not re.match(r'^[\.#\s]+$', content):
-                stripped_line = f"# {content}"
-            else:
-                continue
+    # Удаление пустых и мусорных строк (только точки, решетки или пробелы)
+    text = _JUNK_LINE_RE.sub('', text)
 
-        cleaned_lines.append(stripped_line)
-    
-    return "\n".join(cleaned_lines)
+    # Заголовки вида "1.2 Название" -> "# Название";
+    # строки, где после цифр нет осмысленного текста, удаляются
+    text = _JUNK_HEADER_RE.sub('', text)
+    text = _HEADER_RE.sub(r'# \1', text)
+
+    # Схлопывание образовавшихся пустых строк
+    return _BLANK_LINES_RE.sub('\n', text).strip('\n')
+
+
+@lru_cache(maxsize=8)
+def _get_splitter(chunk_size, chunk_overlap):
+    """Сплиттер создается один раз на каждую пару параметров."""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
 
 
 def split_text(text, chunk_size=1000, chunk_overlap=200):
@@ -158,17 +242,55 @@ def split_text(text, chunk_size=1000, chunk_overlap=200):
     Returns:
         list: Список текстовых чанков
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=len,
-        is_separator_regex=False,
-    )
+    return _get_splitter(chunk_size, chunk_overlap).split_text(text)
+
+
+def _process_one(filepath, source_name, chunk_size, chunk_overlap, max_pdf_pages, max_text_chars, max_chunks):
+    """
+    Чтение, очистка и разбиение на чанки одного файла.
+    
+    Returns:
+        tuple: (имя файла, список чанков); список пуст, если файл пустой
+    """
+    filename = source_name or os.path.basename(filepath)
+    
+    # Чтение файла
+    text = read_file(filepath, max_pdf_pages=max_pdf_pages, max_text_chars=max_text_chars)
+    if not text:
+        return filename, []
     
-    return text_splitter.split_text(text)
+    # Очистка текста
+    cleaned_text = clean_text(text)
+    if not cleaned_text:
+        # Fallback: preserve original text with minimal normalization
+        normalized_text = _WS_RE.sub(" ", text).strip()
+        if not normalized_text:
+            raise ValueError(f"Файл {filename} не содержит извлекаемого текста.")
+        cleaned_text = normalized_text
+    
+    # Разбиение на чанки
+    chunks = split_text(cleaned_text, chunk_size, chunk_overlap)
+    if not chunks:
+        raise ValueError(f"Файл {filename} не содержит текста после очистки.")
+    if max_chunks and len(chunks) > max_chunks:
+        raise ValueError("Файл слишком большой: получилось слишком много чанков.")
+    
+    return filename, chunks
+
+
+def _write_chunk_records(result_file, results):
+    """Запись чанков с метаданными в файл результата. Возвращает число записей."""
+    chunks_count = 0
+    for filename, chunks in results:
+        prefix = f"{CHUNK_HEADER}{filename}, Чанк: "
+        for i, chunk in enumerate(chunks, 1):
+            result_file.writelines((prefix, str(i), "\n\n", chunk, CHUNK_SEPARATOR))
+        chunks_count += len(chunks)
+    return chunks_count
 
 
-def process_files(filepaths, chunk_size=1000, chunk_overlap=200, max_pdf_pages=None, max_text_chars=None, max_chunks=None):
+def process_files(filepaths, chunk_size=1000, chunk_overlap=200, max_pdf_pages=None, max_text_chars=None, max_chunks=None,
+                  source_names=None):
     """
     Обрабатывает список файлов и создает dataset.md.
     
@@ -182,52 +304,36 @@ def process_files(filepaths, chunk_size=1000, chunk_overlap=200, max_pdf_pages=N
         filepaths: Список путей к файлам
         chunk_size: Размер чанка в символах
         chunk_overlap: Перекрытие между чанками
+        source_names: Имена источников для заголовков чанков
+            (по умолчанию - имена файлов из filepaths)
     
     Returns:
         tuple: (путь к результирующему файлу, количество чанков)
     """
-    all_chunks = []
-    
-    for filepath in filepaths:
-        filename = os.path.basename(filepath)
-        
-        # Чтение файла
-        text = read_file(filepath, max_pdf_pages=max_pdf_pages, max_text_chars=max_text_chars)
-        if not text:
-            continue
-        
-        # Очистка текста
-        cleaned_text = clean_text(text)
-        if not cleaned_text.strip():
-            # Fallback: preserve original text with minimal normalization
-            normalized_text = re.sub(r"\s+", " ", text).strip()
-            if not normalized_text:
-                raise ValueError(f"Файл {filename} не содержит извлекаемого текста.")
-            cleaned_text = normalized_text
-        
-        # Разбиение на чанки
-        chunks = split_text(cleaned_text, chunk_size, chunk_overlap)
-        if not chunks:
-            raise ValueError(f"Файл {filename} не содержит текста после очистки.")
-        if max_chunks and len(chunks) > max_chunks:
-            raise ValueError("Файл слишком большой: получилось слишком много чанков.")
-        
-        # Формирование записей с метаданными
-        for i, chunk in enumerate(chunks):
-            chunk_record = f"## Источник: {filename}, Чанк: {i+1}\n\n{chunk}\n\n---\n\n"
-            all_chunks.append(chunk_record)
-    
-    if not all_chunks:
-        raise ValueError("Не удалось сформировать dataset: нет данных для чанков.")
-
-    # Создание временного файла с результатом
+    # Записи чанков пишутся во временный файл по мере формирования,
+    # без накопления всего dataset в памяти
     result_file = tempfile.NamedTemporaryFile(
         mode='w',
         suffix='.md',
         delete=False,
         encoding='utf-8'
     )
-    result_file.writelines(all_chunks)
+    chunks_count = 0
+    args = (chunk_size, chunk_overlap, max_pdf_pages, max_text_chars, max_chunks)
+    sources = list(zip(filepaths, source_names or [None] * len(filepaths)))
+    
+    try:
+        results = (_process_one(filepath, source_name, *args) for filepath, source_name in sources)
+        chunks_count = _write_chunk_records(result_file, results)
+        
+        if not chunks_count:
+            raise ValueError("Не удалось сформировать dataset: нет данных для чанков.")
+    except Exception:
+        # Удаление незавершенного результата при ошибке
+        result_file.close()
+        os.remove(result_file.name)
+        raise
+    
     result_file.close()
     
-    return result_file.name, len(all_chunks)
+    return result_file.name, chunks_count
@@ -1,19 +1,28 @@
 ﻿import os
 import re
-import uuid
-from flask import render_template, redirect, url_for, flash, request, current_app, send_file, after_this_request, Response
+import codecs
+import secrets
+import time
+import shutil
+import hashlib
+from functools import lru_cache
+from flask import render_template, redirect, url_for, flash, request, current_app, send_file, Response, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
+from sqlalchemy import update
 from app import db
 from app.main import bp
-from app.models import ConversionHistory
-from app.converter.processor import process_files
+from app.models import ConversionHistory, UsageCounter
 
 
 # Константы для валидации файлов
 MAX_FILENAME_LENGTH = 255  # Максимальная длина имени файла
 DANGEROUS_EXTENSIONS = {'exe', 'bat', 'cmd', 'sh', 'ps1', 'vbs', 'js', 'jar'}  # Опасные расширения
 
+# Константы сохранения загрузок
+UPLOAD_BLOCK_SIZE = 64 * 1024  # Размер блока при записи и хешировании файла
+UTF8_CHECK_SIZE = 1024  # Сколько байт проверять на корректность UTF-8
+
 
 def allowed_file(filename):
     """
@@ -36,21 +45,15 @@ def allowed_file(filename):
     return True
 
 
-def sanitize_filename(filename):
+def sanitize_filename(safe_name):
     """
     Безопасная обработка имени файла.
-    - Использует secure_filename
-    - Добавляет UUID-префикс для уникальности
+    - Принимает результат secure_filename (вызывается один раз в convert)
+    - Добавляет случайный префикс для уникальности
     - Ограничивает длину имени
     
     Возвращает безопасное имя файла или None.
     """
-    if not filename:
-        return None
-    
-    # Получаем безопасную версию имени
-    safe_name = secure_filename(filename)
-    
     if not safe_name:
         return None
     
@@ -59,39 +62,256 @@ def sanitize_filename(filename):
         name, ext = os.path.splitext(safe_name)
         safe_name = name[:MAX_FILENAME_LENGTH - len(ext) - 10] + ext
     
-    # Добавление UUID-префикса для предотвращения конфликтов и перебора
-    unique_prefix = uuid.uuid4().hex[:8]
+    # Добавление случайного префикса для предотвращения конфликтов и перебора
+    unique_prefix = secrets.token_hex(4)
     safe_name = f"{unique_prefix}_{safe_name}"
     
     return safe_name
 
 
-def validate_file_content(filepath, expected_ext):
+def validate_file_content(header, expected_ext):
     """
     Проверка соответствия содержимого файла его расширению.
-    Базовая проверка по магическим числам (сигнатурам).
+    Базовая проверка по магическим числам (сигнатурам) первого блока файла.
     
     Возвращает True если содержимое соответствует типу.
     """
+    if expected_ext == 'pdf':
+        # PDF файлы начинаются с %PDF
+        return header.startswith(b'%PDF')
+    elif expected_ext == 'txt':
+        # Текстовые файлы - проверяем возможность декодирования как UTF-8
+        # (незавершенный многобайтовый символ в конце блока допустим)
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(header[:UTF8_CHECK_SIZE])
+            return True
+        except UnicodeDecodeError:
+            return False
+    
+    return True
+
+
+def save_upload(file, filepath, expected_ext):
+    """
+    Сохранение загруженного файла за один проход по потоку.
+    Первый блок проверяется по сигнатуре до записи на диск,
+    одновременно считается SHA-256 содержимого для кэша результатов.
+    
+    Возвращает объект хеша или None, если содержимое не соответствует расширению.
+    """
+    block = file.stream.read(UPLOAD_BLOCK_SIZE)
+    if not validate_file_content(block, expected_ext):
+        return None
+    
+    digest = hashlib.sha256()
+    with open(filepath, 'wb') as f:
+        while block:
+            digest.update(block)
+            f.write(block)
+            block = file.stream.read(UPLOAD_BLOCK_SIZE)
+    return digest
+
+
+def remove_file(path):
+    """Удаление файла без предварительной проверки существования (без гонки exists/remove)."""
     try:
-        with open(filepath, 'rb') as f:
-            header = f.read(8)
-        
-        if expected_ext == 'pdf':
-            # PDF файлы начинаются с %PDF
-            return header.startswith(b'%PDF')
-        elif expected_ext == 'txt':
-            # Текстовые файлы - проверяем возможность декодирования как UTF-8
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    f.read(1024)  # Читаем первые 1KB
-                return True
-            except UnicodeDecodeError:
-                return False
-        
-        return True
-    except Exception:
-        return False
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def result_cache_path(content_digest, source_name, chunk_size, chunk_overlap):
+    """
+    Путь к закэшированному результату конвертации.
+    Ключ - SHA-256 содержимого файла вместе с именем источника
+    и параметрами разбиения (все, от чего зависит dataset.md).
+    """
+    digest = content_digest.copy()
+    digest.update(f"\0{source_name}\0{chunk_size}\0{chunk_overlap}".encode('utf-8'))
+    return os.path.join(current_app.config['RESULT_CACHE_FOLDER'], f"{digest.hexdigest()}.md")
+
+
+def count_chunk_records(result_file, source_name):
+    """
+    Подсчет записей чанков в открытом (бинарном) файле dataset.md.
+    Заголовки записей идут с последовательными номерами
+    ('## Источник: <имя>, Чанк: N'), поэтому считается только
+    очередной ожидаемый номер. Файл возвращается на начало.
+    """
+    header_prefix = f"## Источник: {source_name}, Чанк: ".encode('utf-8')
+    count = 0
+    for line in result_file:
+        if line == header_prefix + f"{count + 1}\n".encode('ascii'):
+            count += 1
+    result_file.seek(0)
+    return count
+
+
+def open_cached_result(cache_path):
+    """
+    Открытие результата из кэша, если он есть и не старше RESULT_CACHE_TTL.
+    Открытый дескриптор остается читаемым, даже если другой запрос
+    удалит файл при очистке кэша.
+    
+    Возвращает файловый объект или None.
+    """
+    try:
+        result_file = open(cache_path, 'rb')
+    except FileNotFoundError:
+        return None
+    if time.time() - os.fstat(result_file.fileno()).st_mtime > current_app.config['RESULT_CACHE_TTL']:
+        result_file.close()
+        return None
+    return result_file
+
+
+def purge_result_cache(cache_dir=None):
+    """
+    Очистка кэша результатов: удаляются записи старше RESULT_CACHE_TTL
+    и самые старые сверх RESULT_CACHE_MAX_FILES.
+    Вызывается после каждой конвертации и командой flask purge-result-cache.
+    
+    Возвращает количество удаленных файлов.
+    """
+    cache_dir = cache_dir or current_app.config['RESULT_CACHE_FOLDER']
+    ttl = current_app.config['RESULT_CACHE_TTL']
+    max_files = current_app.config.get('RESULT_CACHE_MAX_FILES', 0)
+    expired_before = time.time() - ttl
+    removed = 0
+    entries = []
+    try:
+        scan = list(os.scandir(cache_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in scan:
+        if not entry.name.endswith('.md'):
+            continue
+        try:
+            mtime = entry.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        if mtime < expired_before:
+            remove_file(entry.path)
+            removed += 1
+        else:
+            entries.append((mtime, entry.path))
+    if max_files and len(entries) > max_files:
+        entries.sort()
+        for _, path in entries[:len(entries) - max_files]:
+            remove_file(path)
+            removed += 1
+    return removed
+
+
+def store_result_in_cache(result_path, cache_path):
+    """
+    Перемещение результата в кэш.
+    Файл сначала копируется рядом с целевым путем, затем атомарно
+    переименовывается, чтобы параллельный запрос не прочитал его частично.
+    """
+    tmp_path = f"{cache_path}.{secrets.token_hex(4)}.tmp"
+    shutil.move(result_path, tmp_path)
+    os.replace(tmp_path, cache_path)
+    purge_result_cache(os.path.dirname(cache_path))
+
+
+def run_conversion(filepath, source_name, cache_path):
+    """
+    Конвертация файла с сохранением результата в кэш.
+    Выполняется в запросе или в воркере RQ (app.tasks).
+    
+    Возвращает количество чанков.
+    """
+    # pypdf и langchain загружаются только при первой конвертации,
+    # а не при импорте блюпринта в каждом воркере/CLI-команде.
+    from app.converter.processor import process_files
+    result_path, chunks_count = process_files(
+        [filepath],
+        chunk_size=current_app.config['CHUNK_SIZE'],
+        chunk_overlap=current_app.config['CHUNK_OVERLAP'],
+        max_pdf_pages=current_app.config.get('MAX_PDF_PAGES'),
+        max_text_chars=current_app.config.get('MAX_TEXT_CHARS'),
+        max_chunks=current_app.config.get('MAX_CHUNKS'),
+        source_names=[source_name]
+    )
+    store_result_in_cache(result_path, cache_path)
+    return chunks_count
+
+
+def record_conversion(user, source_name, chunks_count, count_usage=True):
+    """
+    Учет конвертации: счетчик бесплатных использований и история (один commit).
+    count_usage=False - использование уже зарезервировано при постановке в очередь.
+    """
+    # Increment usage counter (if not subscriber)
+    if count_usage and not (user.subscription and user.subscription.status in ['active', 'cancelled']):
+        if user.usage:
+            user.usage.increment()
+    
+    # Запись в историю конвертаций
+    history_entry = ConversionHistory(
+        user_id=user.id,
+        filename=source_name,
+        chunks_count=chunks_count
+    )
+    db.session.add(history_entry)
+    db.session.commit()
+
+
+def reserve_free_conversion(user):
+    """
+    Резервирование бесплатной конвертации при постановке задачи в очередь.
+    Счетчик увеличивается сразу одним условным UPDATE, поэтому несколько
+    загрузок подряд не обходят FREE_CONVERSIONS_LIMIT, пока задачи ждут воркер.
+    
+    Returns:
+        tuple: (разрешено, счетчик увеличен)
+    """
+    if user.subscription and user.subscription.status in ['active', 'cancelled']:
+        return True, False
+    if not user.usage:
+        return True, False
+    result = db.session.execute(
+        update(UsageCounter)
+        .where(
+            UsageCounter.user_id == user.id,
+            UsageCounter.free_uses < current_app.config['FREE_CONVERSIONS_LIMIT'],
+        )
+        .values(free_uses=UsageCounter.free_uses + 1)
+    )
+    db.session.commit()
+    reserved = result.rowcount == 1
+    return reserved, reserved
+
+
+def refund_free_conversion(user_id):
+    """Возврат зарезервированной бесплатной конвертации (задача не выполнена)."""
+    db.session.execute(
+        update(UsageCounter)
+        .where(UsageCounter.user_id == user_id, UsageCounter.free_uses > 0)
+        .values(free_uses=UsageCounter.free_uses - 1)
+    )
+    db.session.commit()
+
+
+def get_conversion_job(job_id):
+    """
+    Задача конвертации текущего пользователя из очереди RQ.
+    Чужие и несуществующие задачи (или выключенная очередь) - 404.
+    """
+    conversion_queue = current_app.extensions.get('conversion_queue')
+    if conversion_queue is None:
+        abort(404)
+    
+    from rq.exceptions import NoSuchJobError
+    from rq.job import Job
+    try:
+        job = Job.fetch(job_id, connection=conversion_queue.connection)
+    except NoSuchJobError:
+        abort(404)
+    if job.meta.get('user_id') != current_user.id:
+        abort(404)
+    return job
 
 
 @bp.route('/')
@@ -149,39 +369,54 @@ def contact_html_redirect():
     return redirect(url_for('main.contact'), code=301)
 
 
-@bp.route('/robots.txt')
-def robots_txt():
-    base_url = current_app.config.get('CANONICAL_BASE_URL', request.url_root.rstrip('/')).rstrip('/')
-    content = f"""User-agent: *
+# Страницы, перечисляемые в sitemap.xml
+SITEMAP_ENDPOINTS = (
+    'main.index',
+    'main.terms_and_conditions',
+    'main.privacy_policy',
+    'main.refund_policy',
+    'main.about',
+    'main.faq',
+    'main.contact',
+)
+
+
+@lru_cache(maxsize=8)
+def _robots_body(base_url):
+    """Текст robots.txt для base_url (формируется один раз)."""
+    return f"""User-agent: *
 Allow: /
 
 Sitemap: {base_url}/sitemap.xml
 """
-    return Response(content, mimetype='text/plain')
 
 
-@bp.route('/sitemap.xml')
-def sitemap_xml():
-    base_url = current_app.config.get('CANONICAL_BASE_URL', request.url_root.rstrip('/')).rstrip('/')
-    urls = [
-        f"{base_url}{url_for('main.index')}", 
-        f"{base_url}{url_for('main.terms_and_conditions')}", 
-        f"{base_url}{url_for('main.privacy_policy')}", 
-        f"{base_url}{url_for('main.refund_policy')}",
-        f"{base_url}{url_for('main.about')}",
-        f"{base_url}{url_for('main.faq')}",
-        f"{base_url}{url_for('main.contact')}",
-    ]
+@lru_cache(maxsize=8)
+def _sitemap_body(base_url):
+    """XML sitemap для base_url (url_for вызывается один раз, а не на каждый запрос)."""
     items = "\n".join(
-        f"<url><loc>{u}</loc><changefreq>weekly</changefreq><priority>1.0</priority></url>"
-        for u in urls
+        f"<url><loc>{base_url}{url_for(endpoint)}</loc><changefreq>weekly</changefreq><priority>1.0</priority></url>"
+        for endpoint in SITEMAP_ENDPOINTS
     )
-    xml = f"""<?xml version="1.0" encoding="UTF-8"?>
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
 <urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
 {items}
 </urlset>
 """
-    return Response(xml, mimetype='application/xml')
+
+
+def _base_url():
+    return current_app.config.get('CANONICAL_BASE_URL', request.url_root.rstrip('/')).rstrip('/')
+
+
+@bp.route('/robots.txt')
+def robots_txt():
+    return Response(_robots_body(_base_url()), mimetype='text/plain')
+
+
+@bp.route('/sitemap.xml')
+def sitemap_xml():
+    return Response(_sitemap_body(_base_url()), mimetype='application/xml')
 
 
 @bp.route('/dashboard')
@@ -246,68 +481,78 @@ def convert():
         file_ext = file.filename.rsplit('.', 1)[1].lower()
         
         # Secure filename processing
-        original_filename = file.filename
-        safe_filename = sanitize_filename(file.filename)
+        base_safe_name = secure_filename(file.filename)
+        source_name = base_safe_name[:MAX_FILENAME_LENGTH]
+        safe_filename = sanitize_filename(base_safe_name)
         if not safe_filename:
             flash('Invalid filename.', 'error')
             return redirect(request.url)
         
-        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], safe_filename)
+        filepath = str(current_app.config['UPLOAD_FOLDER_PATH'] / safe_filename)
+        result_file = None
         
         try:
-            # Сохранение загруженного файла
-            file.save(filepath)
-            
-            # Check file content matches extension
-            if not validate_file_content(filepath, file_ext):
-                os.remove(filepath)
+            # Сохранение загруженного файла с проверкой содержимого
+            content_digest = save_upload(file, filepath, file_ext)
+            if content_digest is None:
                 flash('File content does not match extension.', 'error')
                 return redirect(request.url)
             
-            # Обработка файла (конвертация)
-            result_path, chunks_count = process_files(
-                [filepath],
-                max_pdf_pages=current_app.config.get('MAX_PDF_PAGES'),
-                max_text_chars=current_app.config.get('MAX_TEXT_CHARS'),
-                max_chunks=current_app.config.get('MAX_CHUNKS')
+            cache_path = result_cache_path(
+                content_digest, source_name,
+                current_app.config['CHUNK_SIZE'], current_app.config['CHUNK_OVERLAP']
             )
             
-            # Удаление временного загруженного файла
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            result_file = open_cached_result(cache_path)
+            if result_file is not None:
+                # Такой же файл недавно конвертировался - отдаем готовый результат
+                chunks_count = count_chunk_records(result_file, source_name)
+            else:
+                conversion_queue = current_app.extensions.get('conversion_queue')
+                if conversion_queue is not None:
+                    # Бесплатная конвертация списывается при постановке в очередь
+                    # и возвращается, если задача завершится ошибкой
+                    reserved, charged = reserve_free_conversion(current_user)
+                    if not reserved:
+                        remove_file(filepath)
+                        flash('Исчерпан лимит бесплатных конвертаций. Оформите подписку.', 'warning')
+                        return redirect(url_for('payment.subscribe'))
+                    
+                    from rq import Callback
+                    try:
+                        # Обработка в воркере RQ; загруженный файл удалит задача
+                        job = conversion_queue.enqueue(
+                            'app.tasks.convert_file_job',
+                            filepath, source_name, cache_path, current_user.id, charged,
+                            result_ttl=current_app.config['CONVERSION_RESULT_TTL'],
+                            meta={'user_id': current_user.id, 'cache_path': cache_path, 'charged': charged},
+                            on_failure=Callback('app.tasks.refund_conversion_job'),
+                        )
+                    except Exception:
+                        if charged:
+                            refund_free_conversion(current_user.id)
+                        raise
+                    return redirect(url_for('main.convert_status', job_id=job.id))
+                chunks_count = run_conversion(filepath, source_name, cache_path)
+                # Результат открывается до учета конвертации: очистка кэша
+                # другим запросом уже не помешает его отдать
+                result_file = open(cache_path, 'rb')
             
-            # Increment usage counter (if not subscriber)
-            if not (current_user.subscription and current_user.subscription.status in ['active', 'cancelled']):
-                if current_user.usage:
-                    current_user.usage.increment()
+            # Удаление временного загруженного файла
+            remove_file(filepath)
             
-            # Запись в историю конвертаций
-            history_entry = ConversionHistory(
-                user_id=current_user.id,
-                filename=secure_filename(original_filename)[:255],
-                chunks_count=chunks_count
-            )
-            db.session.add(history_entry)
-            db.session.commit()
+            record_conversion(current_user, source_name, chunks_count)
             
             flash(f'Conversion successful! Created {chunks_count} chunks.', 'success')
             
-            # Отправка результата пользователю
-            # Delete file after sending
-            @after_this_request
-            def remove_file(response):
-                try:
-                    os.remove(result_path)
-                except Exception as error:
-                    current_app.logger.error(f"Error removing downloaded file: {error}")
-                return response
-
-            return send_file(result_path, as_attachment=True, download_name='dataset.md')
+            # Отправка результата пользователю (файл остается в кэше до истечения срока)
+            return send_file(result_file, as_attachment=True, download_name='dataset.md')
             
         except Exception as e:
             # Очистка при ошибке
-            if os.path.exists(filepath):
-                os.remove(filepath)
+            if result_file is not None:
+                result_file.close()
+            remove_file(filepath)
             current_app.logger.error(f'Conversion error for user {current_user.id}: {str(e)}')
             if isinstance(e, ValueError):
                 flash(str(e), 'error')
@@ -321,3 +566,33 @@ def convert():
     )
 
 
+@bp.route('/convert/status/<job_id>')
+@login_required
+def convert_status(job_id):
+    """Статус фоновой конвертации (страница обновляется, пока задача не завершится)."""
+    job = get_conversion_job(job_id)
+    status = job.get_status()
+    
+    if status == 'finished':
+        return render_template('convert_status.html', job_id=job_id, finished=True, chunks_count=job.return_value())
+    
+    if job.is_failed or status in ('stopped', 'canceled'):
+        flash(job.meta.get('error') or 'Error processing file. Please try another file.', 'error')
+        return redirect(url_for('main.convert'))
+    
+    return render_template('convert_status.html', job_id=job_id, finished=False)
+
+
+@bp.route('/convert/result/<job_id>')
+@login_required
+def convert_result(job_id):
+    """Скачивание результата завершенной фоновой конвертации."""
+    job = get_conversion_job(job_id)
+    cache_path = job.meta.get('cache_path')
+    result_file = None
+    if job.get_status() == 'finished' and cache_path:
+        result_file = open_cached_result(cache_path)
+    if result_file is None:
+        flash('Conversion result is no longer available. Please convert the file again.', 'error')
+        return redirect(url_for('main.convert'))
+    return send_file(result_file, as_attachment=True, download_name='dataset.md')
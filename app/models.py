@@ -1,9 +1,24 @@
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from werkzeug.security import check_password_hash
 from flask_login import UserMixin
+from sqlalchemy.orm import joinedload
 from app import db, login_manager
 
 
+# Хеширование паролей Argon2id (параметры по рекомендациям OWASP).
+# Старые хеши Werkzeug (pbkdf2/scrypt) проверяются как раньше
+# и заменяются на Argon2 при следующем успешном входе.
+_PASSWORD_HASHER = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+ARGON2_HASH_PREFIX = '$argon2'
+
+
+def hash_password(password):
+    """Хеш пароля для хранения в User.password_hash."""
+    return _PASSWORD_HASHER.hash(password)
+
+
 class User(UserMixin, db.Model):
     """Модель пользователя."""
     __tablename__ = 'users'
@@ -20,11 +35,22 @@ class User(UserMixin, db.Model):
     
     def set_password(self, password):
         """Хеширование пароля."""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
         """Проверка пароля."""
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith(ARGON2_HASH_PREFIX):
+            return check_password_hash(self.password_hash, password)
+        try:
+            return _PASSWORD_HASHER.verify(self.password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    
+    def password_needs_rehash(self):
+        """Хеш устарел (не Argon2 или другие параметры) и должен быть пересчитан."""
+        if not self.password_hash.startswith(ARGON2_HASH_PREFIX):
+            return True
+        return _PASSWORD_HASHER.check_needs_rehash(self.password_hash)
     
     def can_convert(self):
         """Проверка, может ли пользователь выполнить конвертацию."""
@@ -49,6 +75,10 @@ class User(UserMixin, db.Model):
 class Subscription(db.Model):
     """Модель подписки пользователя."""
     __tablename__ = 'subscriptions'
+    __table_args__ = (
+        # Одна подписка на пользователя; цель ON CONFLICT в callback
+        db.Index('uq_subscriptions_user_id', 'user_id', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -59,14 +89,17 @@ class Subscription(db.Model):
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def is_active(self):
-        """Проверка активности подписки."""
+        """
+        Проверка активности подписки.
+        Истекшая подписка помечается как inactive; сохранение
+        изменения (commit) выполняет вызывающий код.
+        """
         # Подписка считается активной, если статус active или cancelled (но еще не истекла)
         if self.status not in ['active', 'cancelled']:
             return False
             
         if self.expires_at and self.expires_at < datetime.utcnow():
             self.status = 'inactive'
-            db.session.commit()
             return False
             
         return True
@@ -84,9 +117,8 @@ class UsageCounter(db.Model):
     free_uses = db.Column(db.Integer, default=0)
     
     def increment(self):
-        """Увеличение счетчика использований."""
+        """Увеличение счетчика использований (commit выполняет вызывающий код)."""
         self.free_uses += 1
-        db.session.commit()
     
     def __repr__(self):
         return f'<UsageCounter {self.user_id}: {self.free_uses}>'
@@ -95,6 +127,10 @@ class UsageCounter(db.Model):
 class ConversionHistory(db.Model):
     """История конвертаций пользователя."""
     __tablename__ = 'conversion_history'
+    __table_args__ = (
+        # История пользователя выбирается по user_id с сортировкой по дате
+        db.Index('ix_conv_user_created', 'user_id', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -108,5 +144,12 @@ class ConversionHistory(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id):
-    """Загрузка пользователя для Flask-Login."""
-    return User.query.get(int(user_id))
+    """
+    Загрузка пользователя для Flask-Login.
+    Подписка и счетчик загружаются тем же запросом (JOIN), так как
+    нужны почти каждому авторизованному обработчику.
+    """
+    return db.session.get(
+        User, int(user_id),
+        options=[joinedload(User.subscription), joinedload(User.usage)]
+    )
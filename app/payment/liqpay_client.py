@@ -1,9 +1,50 @@
-import base64
 import hashlib
-import json
+import hmac
 from datetime import datetime, timedelta
 from flask import current_app
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import pybase64 as base64  # SIMD-реализация с тем же API, что и stdlib
+except ImportError:  # pybase64 не установлен - используется стандартный base64
+    import base64
+try:
+    import orjson
+except ImportError:  # orjson не установлен - используется стандартный json
+    orjson = None
+    import json
+
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj):
+        """Компактный JSON в UTF-8 (тот же вывод, что у orjson.dumps)."""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    _json_loads = json.loads
+
+
+# Заглушки переменных полей в JSON-шаблоне формы подписки
+_ORDER_ID_FIELD = b'"order_id":"__ORDER_ID__"'
+_DATE_START_FIELD = b'"subscribe_date_start":"__DATE_START__"'
+
+# Длина подписи LiqPay: base64 от 20-байтового SHA1
+SIGNATURE_LENGTH = 28
+
+# Отсрочка первого списания подписки от момента создания формы
+_SUBSCRIBE_START_DELAY = timedelta(minutes=5)
+
+# Общая сессия для запросов к API LiqPay: keep-alive соединения
+# переиспользуются между вызовами (без нового TCP+TLS рукопожатия).
+# POST по умолчанию не повторяется Retry - повторы только при ошибках соединения.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+))
 
 
 class LiqPayClient:
@@ -18,6 +59,10 @@ class LiqPayClient:
     
     CHECKOUT_URL = 'https://www.liqpay.ua/api/3/checkout'
     
+    # JSON-шаблоны формы подписки: все поля, кроме order_id и
+    # subscribe_date_start, постоянны для развертывания
+    _form_templates = {}
+    
     def __init__(self, public_key=None, private_key=None):
         """
         Инициализация клиента LiqPay.
@@ -28,6 +73,13 @@ class LiqPayClient:
         """
         self.public_key = public_key or current_app.config.get('LIQPAY_PUBLIC_KEY')
         self.private_key = private_key or current_app.config.get('LIQPAY_PRIVATE_KEY')
+        
+        # SHA1-контекст, в который ключ-префикс подписи уже подан (копируется на каждую подпись)
+        self._private_key_bytes = None
+        self._sig_prefix_ctx = None
+        if self.private_key:
+            self._private_key_bytes = self.private_key.encode('utf-8')
+            self._sig_prefix_ctx = hashlib.sha1(self._private_key_bytes)
     
     def _encode_params(self, params):
         """
@@ -39,8 +91,7 @@ class LiqPayClient:
         Returns:
             str: Закодированная строка
         """
-        params_json = json.dumps(params, ensure_ascii=False)
-        return base64.b64encode(params_json.encode('utf-8')).decode('utf-8')
+        return base64.b64encode(_json_dumps(params)).decode('utf-8')
     
     def _generate_signature(self, data):
         """
@@ -53,10 +104,12 @@ class LiqPayClient:
         Returns:
             str: Подпись в base64
         """
-        sign_string = self.private_key + data + self.private_key
-        return base64.b64encode(
-            hashlib.sha1(sign_string.encode('utf-8')).digest()
-        ).decode('utf-8')
+        if self._sig_prefix_ctx is None:
+            raise ValueError('LiqPay private key is not configured.')
+        sign_hash = self._sig_prefix_ctx.copy()
+        sign_hash.update(data.encode('utf-8'))
+        sign_hash.update(self._private_key_bytes)
+        return base64.b64encode(sign_hash.digest()).decode('utf-8')
     
     def create_subscription_form(self, order_id, amount, description, result_url, server_url):
         """
@@ -72,21 +125,32 @@ class LiqPayClient:
         Returns:
             dict: {data, signature, checkout_url} для формы
         """
-        params = {
-            'version': 3,
-            'public_key': self.public_key,
-            'action': 'subscribe',  # Подписка с рекуррентными платежами
-            'amount': str(amount),
-            'currency': 'UAH',
-            'description': description,
-            'order_id': order_id,
-            'subscribe_periodicity': 'month',
-            'subscribe_date_start':  (datetime.utcnow() + timedelta(minutes=5)).strftime('%Y-%m-%d %H:%M:%S'),
-            'result_url': result_url,
-            'server_url': server_url
-        }
-        
-        data = self._encode_params(params)
+        template_key = (self.public_key, str(amount), description, result_url, server_url)
+        template = self._form_templates.get(template_key)
+        if template is None:
+            template = _json_dumps({
+                'version': 3,
+                'public_key': self.public_key,
+                'action': 'subscribe',  # Подписка с рекуррентными платежами
+                'amount': str(amount),
+                'currency': 'UAH',
+                'description': description,
+                'order_id': '__ORDER_ID__',
+                'subscribe_periodicity': 'month',
+                'subscribe_date_start': '__DATE_START__',
+                'result_url': result_url,
+                'server_url': server_url
+            })
+            self._form_templates[template_key] = template
+        
+        date_start = (datetime.utcnow() + _SUBSCRIBE_START_DELAY).strftime('%Y-%m-%d %H:%M:%S')
+        params_json = template.replace(
+            _ORDER_ID_FIELD, b'"order_id":' + _json_dumps(order_id), 1
+        ).replace(
+            _DATE_START_FIELD, f'"subscribe_date_start":"{date_start}"'.encode('utf-8'), 1
+        )
+        
+        data = base64.b64encode(params_json).decode('utf-8')
         signature = self._generate_signature(data)
         
         return {
@@ -106,15 +170,16 @@ class LiqPayClient:
         Returns:
             dict: Декодированные данные или None если подпись неверна
         """
-        # Проверка подписи
+        # Проверка подписи (подпись не той длины отклоняется без вычисления SHA1)
+        if not isinstance(signature, str) or len(signature) != SIGNATURE_LENGTH:
+            return None
         expected_signature = self._generate_signature(data)
-        if signature != expected_signature:
+        if not hmac.compare_digest(signature.encode('utf-8'), expected_signature.encode('utf-8')):
             return None
         
         # Декодирование данных
         try:
-            decoded = base64.b64decode(data).decode('utf-8')
-            return json.loads(decoded)
+            return _json_loads(base64.b64decode(data))
         except Exception:
             return None
     
@@ -139,7 +204,7 @@ class LiqPayClient:
         signature = self._generate_signature(data)
         
         try:
-            response = requests.post(
+            response = _session.post(
                 'https://www.liqpay.ua/api/request',
                 data={
                     'data': data,
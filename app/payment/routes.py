@@ -1,12 +1,59 @@
-﻿import hmac
+﻿import re
+import hmac
 import hashlib
 from datetime import datetime, timedelta
-from flask import render_template, redirect, url_for, flash, request, current_app
+from functools import lru_cache
+from flask import render_template, redirect, url_for, flash, request, current_app, session, make_response
 from flask_login import login_required, current_user
+from sqlalchemy import inspect, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from app import db
+from app.models import User, Subscription
 from app.payment import bp
 
 
+# Длина IPN_HASH в байтах (SHA-256)
+_IPN_HASH_SIZE = 32
+
+# Поле x-user-id в ORDER_CUSTOM_FIELDS (пары key=value через запятую)
+_USER_ID_FIELD_RE = re.compile(r'(?:^|,)\s*x-user-id\s*=([^,]*)')
+
+# Срок подписки, если PayPro не прислал корректную дату следующего платежа
+_PAYPRO_GRACE = timedelta(days=32)
+
+# Дата следующего платежа PayPro: YYYY-MM-DD (месяц и день могут быть без ведущего нуля)
+_REBILL_DATE_RE = re.compile(r'(\d{4})-(1[0-2]|0[1-9]|[1-9])-(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])')
+
+
+def _parse_rebill_date(value):
+    """
+    Разбор даты NEXT_REBILL_DATE (формат YYYY-MM-DD).
+    Предкомпилированный шаблон повторяет правила strptime('%Y-%m-%d')
+    без накладных расходов strptime на каждый вызов.
+    """
+    match = _REBILL_DATE_RE.fullmatch(value)
+    if match is None:
+        raise ValueError(f"Invalid NEXT_REBILL_DATE: {value!r}")
+    year, month, day = match.groups()
+    return datetime(int(year), int(month), int(day))
+
+
+def _form_value(data, key):
+    """Значение поля IPN как строка (поля формы уже строки - без лишнего str())."""
+    value = data.get(key, '')
+    return value if isinstance(value, str) else str(value)
+
+
+def _paypro_expected_hash(order_id, order_status, total_amount, customer_email, secret_key, test_mode, ipn_type_name):
+    """Ожидаемый IPN_HASH для набора полей"""
+    # Поля дописываются в один буфер без промежуточного списка и join
+    payload = bytearray()
+    for value in (order_id, order_status, total_amount, customer_email, secret_key, test_mode, ipn_type_name):
+        payload += value if isinstance(value, bytes) else value.encode('utf-8')
+    return hashlib.sha256(payload).digest()
+
+
 def _verify_paypro_hash(data, secret_key):
     """
     Верификация хеша PayPro Global (IPN).
@@ -15,20 +62,25 @@ def _verify_paypro_hash(data, secret_key):
     if not secret_key:
         return True  # Временно разрешаем для тестов, если ключ не задан
     
+    # Сравнение сырых байтов дайджеста: без hex-кодирования и lower().
+    # Подпись не той длины отклоняется до вычисления SHA-256.
+    try:
+        received = bytes.fromhex(_form_value(data, 'IPN_HASH'))
+    except ValueError:
+        return False
+    if len(received) != _IPN_HASH_SIZE:
+        return False
+    
     # Поля для хеша в строгом порядке PayPro Global
-    hash_fields = [
-        str(data.get('ORDER_ID', '')),
-        str(data.get('ORDER_STATUS', '')),
-        str(data.get('ORDER_TOTAL_AMOUNT', '')),
-        str(data.get('CUSTOMER_EMAIL', '')),
+    expected = _paypro_expected_hash(
+        _form_value(data, 'ORDER_ID'),
+        _form_value(data, 'ORDER_STATUS'),
+        _form_value(data, 'ORDER_TOTAL_AMOUNT'),
+        _form_value(data, 'CUSTOMER_EMAIL'),
         secret_key,
-        str(data.get('TEST_MODE', '')),
-        str(data.get('IPN_TYPE_NAME', ''))
-    ]
-    
-    payload = "".join(hash_fields)
-    expected = hashlib.sha256(payload.encode('utf-8')).hexdigest().lower()
-    received = str(data.get('IPN_HASH', '')).lower()
+        _form_value(data, 'TEST_MODE'),
+        _form_value(data, 'IPN_TYPE_NAME'),
+    )
     
     return hmac.compare_digest(expected, received)
 
@@ -39,16 +91,98 @@ def _get_user_id_from_paypro(data):
     if not custom_fields:
         return None
     
-    try:
-        pairs = custom_fields.split(',')
-        for pair in pairs:
-            if '=' in pair:
-                k, v = pair.split('=', 1)
-                if k.strip() == 'x-user-id':
-                    return v.strip()
-    except Exception:
-        pass
-    return None
+    match = _USER_ID_FIELD_RE.search(custom_fields)
+    return match.group(1).strip() if match else None
+
+
+# Уникальный индекс subscriptions.user_id - цель ON CONFLICT
+_SUBSCRIPTION_USER_INDEX = 'uq_subscriptions_user_id'
+
+# SQLSTATE нарушения внешнего ключа в PostgreSQL
+_PG_FOREIGN_KEY_VIOLATION = '23503'
+
+# Наличие индекса по URL базы (проверяется один раз на процесс)
+_upsert_index_cache = {}
+
+
+def _subscription_upsert_available():
+    """
+    Можно ли выполнять INSERT ... ON CONFLICT (user_id): только PostgreSQL
+    и только если уникальный индекс уже создан (init-db не меняет
+    существующие таблицы - индекс на старых базах добавляется вручную,
+    см. DEPLOY.md). Индекс, созданный после старта, подхватывается
+    после перезапуска процесса.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        return False
+    key = str(engine.url)
+    if key not in _upsert_index_cache:
+        _upsert_index_cache[key] = any(
+            index['name'] == _SUBSCRIPTION_USER_INDEX and index['unique']
+            for index in inspect(engine).get_indexes(Subscription.__tablename__)
+        )
+    return _upsert_index_cache[key]
+
+
+def apply_subscription_event(user_id, values):
+    """
+    Запись изменения подписки пользователя (один commit).
+    Выполняется в запросе callback или в воркере RQ (app.tasks).
+    
+    Возвращает False, если пользователь не найден.
+    """
+    if _subscription_upsert_available():
+        # Один INSERT ... ON CONFLICT (user_id) DO UPDATE; несуществующего
+        # пользователя отсекает внешний ключ
+        stmt = pg_insert(Subscription).values(user_id=user_id, **values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Subscription.user_id],
+            set_=dict(values, updated_at=datetime.utcnow()),
+        )
+        try:
+            db.session.execute(stmt)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            sqlstate = getattr(e.orig, 'sqlstate', None) or getattr(e.orig, 'pgcode', None)
+            if sqlstate == _PG_FOREIGN_KEY_VIOLATION:
+                current_app.logger.warning(f"PayPro IPN: user {user_id} not found")
+                return False
+            current_app.logger.error(f"Subscription upsert failed for user {user_id}: {str(e)}")
+            raise
+        return True
+
+    # Остальные СУБД (SQLite не проверяет внешние ключи по умолчанию)
+    # и PostgreSQL без уникального индекса.
+    # Обычный случай - подписка уже есть: один UPDATE без предварительных SELECT
+    result = db.session.execute(
+        update(Subscription).where(Subscription.user_id == user_id).values(**values)
+    )
+    if result.rowcount == 0:
+        # Подписки нет (или нет пользователя) - создаем запись
+        if db.session.get(User, user_id) is None:
+            db.session.rollback()
+            return False
+        db.session.add(Subscription(user_id=user_id, **values))
+    db.session.commit()
+    return True
+
+
+@lru_cache(maxsize=1)
+def _subscribe_page_digest():
+    """
+    Хеш исходников шаблонов страницы подписки и конфигурации, которую выводит
+    base.html: канонический домен и данные оператора (меняется только при деплое).
+    """
+    digest = hashlib.sha256()
+    for name in ('base.html', 'subscribe.html'):
+        source, _, _ = current_app.jinja_loader.get_source(current_app.jinja_env, name)
+        digest.update(source.encode('utf-8'))
+    config = current_app.config
+    for key in sorted(k for k in config if k == 'CANONICAL_BASE_URL' or k.startswith('SERVICE_OPERATOR_')):
+        digest.update(f"\0{key}={config[key]}".encode('utf-8'))
+    return digest.hexdigest()
 
 
 @bp.route('/subscribe')
@@ -58,17 +192,48 @@ def subscribe():
         if current_user.subscription.is_active():
             flash('You already have an active subscription.', 'info')
             return redirect(url_for('main.dashboard'))
+        # Подписка истекла - сохраняем новый статус
+        db.session.commit()
 
-    return render_template(
+    price = current_app.config['SUBSCRIPTION_PRICE']
+    checkout_url = current_app.config['PAYPRO_CHECKOUT_URL']
+    
+    # Страница зависит только от пользователя, тарифа, адреса сайта (canonical URL
+    # без CANONICAL_BASE_URL строится из него), шаблонов и данных оператора: повторный
+    # запрос браузера с тем же ETag получает 304 без рендеринга шаблона.
+    # Ожидающие flash-сообщения выводятся в шаблоне, поэтому тогда рендерим всегда.
+    etag = None
+    if not session.get('_flashes'):
+        etag = hashlib.sha256(
+            f"{current_user.id}\0{price}\0{checkout_url}\0{request.url_root}\0"
+            f"{_subscribe_page_digest()}".encode('utf-8')
+        ).hexdigest()
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+    response = make_response(render_template(
         'subscribe.html',
-        price=current_app.config['SUBSCRIPTION_PRICE'],
-        paypro_checkout_url=current_app.config['PAYPRO_CHECKOUT_URL'],
+        price=price,
+        paypro_checkout_url=checkout_url,
         user_id=current_user.id,
-    )
+    ))
+    if etag is not None:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+    return response
 
 
 @bp.route('/callback', methods=['POST'])
 def callback():
+    # IPN - небольшая форма; большое тело отклоняется, не разбирая его
+    max_length = current_app.config['PAYPRO_CALLBACK_MAX_LENGTH']
+    if request.content_length is not None and request.content_length > max_length:
+        current_app.logger.warning(f"PayPro IPN rejected: body of {request.content_length} bytes")
+        return 'Payload too large', 413
+
     # PayPro Global присылает данные в x-www-form-urlencoded (request.form)
     data = request.form.to_dict()
     secret = current_app.config.get('PAYPRO_SECRET_KEY')
@@ -82,49 +247,56 @@ def callback():
         current_app.logger.error(f"PayPro IPN: user_id missing for order {data.get('ORDER_ID')}")
         return 'OK', 200 # Возвращаем 200 чтобы не зацикливать ретраи
 
-    from app.models import User, Subscription
     try:
-        user = User.query.get(int(user_id))
+        user_id = int(user_id)
     except (ValueError, TypeError):
         return 'OK', 200
 
-    if not user:
-        return 'OK', 200
-
     ipn_type_id = data.get('IPN_TYPE_ID')
     subscription_id = data.get('SUBSCRIPTION_ID')
     
-    if not user.subscription:
-        user.subscription = Subscription(user_id=user.id)
-        db.session.add(user.subscription)
+    # Новые значения полей подписки для события
+    # 1 = OrderCharged, 6 = SubscriptionChargeSucceed, 9 = SubscriptionRenewed
+    if ipn_type_id in ['1', '6', '9']:
+        values = {'status': 'active'}
+        if subscription_id:
+            values['liqpay_order_id'] = str(subscription_id)
+        
+        # Пытаемся распарсить дату следующего платежа
+        next_bill = data.get('NEXT_REBILL_DATE')
+        if next_bill:
+            try:
+                values['expires_at'] = _parse_rebill_date(next_bill)
+            except Exception:
+                values['expires_at'] = datetime.utcnow() + _PAYPRO_GRACE
+        else:
+            values['expires_at'] = datetime.utcnow() + _PAYPRO_GRACE
+        log_message = f"Subscription ACTIVATED for user {user_id} (Order {data.get('ORDER_ID')})"
 
-    try:
-        # 1 = OrderCharged, 6 = SubscriptionChargeSucceed, 9 = SubscriptionRenewed
-        if ipn_type_id in ['1', '6', '9']:
-            user.subscription.status = 'active'
-            if subscription_id:
-                user.subscription.liqpay_order_id = str(subscription_id)
-            
-            # Пытаемся распарсить дату следующего платежа
-            next_bill = data.get('NEXT_REBILL_DATE')
-            if next_bill:
-                try:
-                    # Ожидаемый формат YYYY-MM-DD
-                    user.subscription.expires_at = datetime.strptime(next_bill, '%Y-%m-%d')
-                except Exception:
-                    user.subscription.expires_at = datetime.utcnow() + timedelta(days=32)
-            else:
-                user.subscription.expires_at = datetime.utcnow() + timedelta(days=32)
-            
-            db.session.commit()
-            current_app.logger.info(f"Subscription ACTIVATED for user {user.id} (Order {data.get('ORDER_ID')})")
+    # 10 = SubscriptionTerminated, 11 = SubscriptionFinished
+    elif ipn_type_id in ['10', '11']:
+        values = {'status': 'cancelled'}
+        log_message = f"Subscription CANCELLED for user {user_id}"
 
-        # 10 = SubscriptionTerminated, 11 = SubscriptionFinished
-        elif ipn_type_id in ['10', '11']:
-            user.subscription.status = 'cancelled'
-            db.session.commit()
-            current_app.logger.info(f"Subscription CANCELLED for user {user.id}")
+    else:
+        return 'OK', 200
+
+    webhook_queue = current_app.extensions.get('webhook_queue')
+    if webhook_queue is not None:
+        # Запись в БД выполняет воркер RQ; PayPro получает 200 сразу после проверки подписи
+        from rq import Retry
+        try:
+            webhook_queue.enqueue(
+                'app.tasks.apply_subscription_event_job', user_id, values, log_message,
+                retry=Retry(max=3, interval=[10, 30, 60]),
+            )
+            return 'OK', 200
+        except Exception as e:
+            current_app.logger.warning(f"PayPro webhook queue unavailable, applying inline: {str(e)}")
 
+    try:
+        if apply_subscription_event(user_id, values):
+            current_app.logger.info(log_message)
     except Exception as e:
         db.session.rollback()
         current_app.logger.error(f"Database error in PayPro webhook: {str(e)}")
@@ -0,0 +1,85 @@
+"""
+Фоновые задачи RQ: конвертация файлов и применение IPN PayPro.
+
+Запуск воркера (из корня проекта, с теми же переменными окружения,
+что и у веб-приложения):
+    rq worker conversions webhooks --url $REDIS_URL
+"""
+from rq import get_current_job
+
+# Приложение создается один раз на процесс воркера
+_app = None
+
+
+def _get_app():
+    global _app
+    if _app is None:
+        from app import create_app
+        _app = create_app()
+    return _app
+
+
+def convert_file_job(filepath, source_name, cache_path, user_id, charged=False):
+    """
+    Конвертация загруженного файла в воркере RQ.
+    Результат сохраняется в кэш (путь cache_path), загруженный файл удаляется.
+    Понятные пользователю ошибки (ValueError) сохраняются в job.meta['error'].
+    charged - бесплатная конвертация уже списана при постановке в очередь
+    (при ошибке ее возвращает refund_conversion_job).
+
+    Returns:
+        int: Количество чанков
+    """
+    app = _get_app()
+    with app.app_context():
+        from app import db
+        from app.main.routes import run_conversion, record_conversion, remove_file
+        from app.models import User
+
+        try:
+            chunks_count = run_conversion(filepath, source_name, cache_path)
+        except ValueError as e:
+            job = get_current_job()
+            if job is not None:
+                job.meta['error'] = str(e)
+                job.save_meta()
+            raise
+        finally:
+            remove_file(filepath)
+
+        user = db.session.get(User, user_id)
+        if user is not None:
+            record_conversion(user, source_name, chunks_count, count_usage=not charged)
+        return chunks_count
+
+
+def refund_conversion_job(job, connection, type, value, traceback):
+    """
+    on_failure-колбэк задачи конвертации (ошибка обработки или таймаут):
+    возврат бесплатной конвертации, списанной при постановке в очередь.
+    """
+    if not job.meta.get('charged'):
+        return
+    app = _get_app()
+    with app.app_context():
+        from app.main.routes import refund_free_conversion
+        refund_free_conversion(job.meta['user_id'])
+
+
+def apply_subscription_event_job(user_id, values, log_message):
+    """
+    Применение изменения подписки из IPN PayPro в воркере RQ.
+    Запись идемпотентна (одни и те же значения полей), поэтому
+    повтор задачи или повторная доставка IPN безопасны.
+    """
+    app = _get_app()
+    with app.app_context():
+        from app import db
+        from app.payment.routes import apply_subscription_event
+
+        try:
+            if apply_subscription_event(user_id, values):
+                app.logger.info(log_message)
+        except Exception:
+            db.session.rollback()
+            raise
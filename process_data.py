@@ -1,12 +1,103 @@
 import os
-import json
+import re
+import hashlib
+import sqlite3
+from functools import lru_cache
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
+try:
+    import pymupdf
+except ImportError:  # PyMuPDF не установлен - используется только pypdf
+    pymupdf = None
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from sentence_transformers import SentenceTransformer
+try:
+    import orjson
+except ImportError:  # orjson не установлен - используется стандартный json
+    orjson = None
+    import json
+
+
+if orjson is not None:
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    def _json_dumps(obj):
+        """Компактный JSON в UTF-8 (тот же вывод, что у orjson.dumps)."""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    _json_loads = json.loads
+
+
+# Модель эмбеддингов
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+# Размер батча для model.encode
+EMBEDDING_BATCH_SIZE = 64
+# Максимум модуля int8 при симметричном квантовании эмбеддингов
+EMBEDDING_INT8_MAX = 127
+# Сколько файлов отдается воркеру пула за раз в read_files
+READ_FILES_CHUNKSIZE = 4
+# Кэш чанков и эмбеддингов по хешу содержимого документа
+EMBEDDING_CACHE_PATH = os.path.join(".cache", "embeddings.sqlite")
+# Меняется при изменении очистки, разбиения или квантования - старые записи кэша не подходят
+EMBEDDING_CACHE_VERSION = b"1"
+
+# Регулярные выражения clean_text (компилируются один раз при импорте)
+_RE_SOURCE = re.compile(r'^## Источник:.*$', re.MULTILINE)
+_RE_DOTS = re.compile(r'\.{2,}')
+_RE_UNI = re.compile(r'/uni([0-9A-Fa-f]{4})')
+_RE_JUNK = re.compile(r'^[\.#\s]+$')
+# Построчные варианты для всего буфера: [^\S\n] - пробельный символ, кроме перевода строки
+_RE_TAIL_NUM_LINES = re.compile(r'[^\S\n]+\d+$', re.MULTILINE)
+_RE_JUNK_LINES = re.compile(r'^(?:[\.#]|[^\S\n])+$', re.MULTILINE)
+_RE_HEADER_LINES = re.compile(r'^(\d+(?:(?:\.|[^\S\n])\d+)*)[^\S\n]+(.*)$', re.MULTILINE)
+_RE_BLANK_LINES = re.compile(r'\n{2,}')
+
+# Сплиттер создается один раз и используется для всех документов
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1000,
+    chunk_overlap=200,
+    length_function=len,
+    is_separator_regex=False,
+)
+
+def _read_pdf(filepath):
+    """
+    Извлекает текст PDF. Основной движок - PyMuPDF (MuPDF, C), как в
+    app/converter/processor.py; pypdf используется, если PyMuPDF не установлен
+    или не смог разобрать файл.
+    """
+    if pymupdf is not None:
+        try:
+            with pymupdf.open(filepath) as doc:
+                return "".join(page.get_text("text") + "\n" for page in doc)
+        except pymupdf.FileDataError:
+            pass
+    reader = PdfReader(filepath)
+    return "".join(page.extract_text() + "\n" for page in reader.pages)
+
+def _read_one(filepath):
+    """
+    Читает один файл .txt или .pdf (выполняется в процессе-воркере).
+    Возвращает (имя_файла, текст, ошибка).
+    """
+    filename = os.path.basename(filepath)
+    try:
+        if filename.lower().endswith(".txt"):
+            # Читаем TXT файл
+            with open(filepath, "r", encoding="utf-8") as f:
+                text = f.read()
+        else:
+            # Читаем PDF файл
+            text = _read_pdf(filepath)
+    except Exception as e:
+        return filename, "", str(e)
+    return filename, text, None
 
 def read_files(directory):
     """
     Читает все файлы .txt и .pdf из указанной папки.
+    Файлы разбираются параллельно в пуле процессов (pypdf упирается в GIL).
     Возвращает список кортежей (имя_файла, текст).
     """
     documents = []
@@ -15,32 +106,45 @@ def read_files(directory):
         print(f"Папка '{directory}' не найдена.")
         return documents
 
-    for filename in os.listdir(directory):
-        filepath = os.path.join(directory, filename)
-        text = ""
+    # Пропускаем файлы других форматов
+    paths = [
+        os.path.join(directory, filename)
+        for filename in os.listdir(directory)
+        if filename.lower().endswith((".txt", ".pdf"))
+    ]
 
-        try:
-            if filename.lower().endswith(".txt"):
-                # Читаем TXT файл
-                with open(filepath, "r", encoding="utf-8") as f:
-                    text = f.read()
-            elif filename.lower().endswith(".pdf"):
-                # Читаем PDF файл
-                reader = PdfReader(filepath)
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-            else:
-                continue # Пропускаем файлы других форматов
-            
-            if text:
-                documents.append((filename, text))
-                print(f"Прочитан файл: {filename}")
-        
-        except Exception as e:
-            print(f"Ошибка при чтении файла {filename}: {e}")
+    if len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = list(executor.map(_read_one, paths, chunksize=READ_FILES_CHUNKSIZE))
+    else:
+        results = [_read_one(path) for path in paths]
+
+    for filename, text, error in results:
+        if error is not None:
+            print(f"Ошибка при чтении файла {filename}: {error}")
+        elif text:
+            documents.append((filename, text))
+            print(f"Прочитан файл: {filename}")
 
     return documents
 
+def _replace_uni(match):
+    """Замена /uniXXXX на соответствующий символ."""
+    try:
+        return chr(int(match.group(1), 16))
+    except:
+        return match.group(0)
+
+def _replace_header(match):
+    """Строка-заголовок '8 1.4 Недостатки' -> '# Недостатки'."""
+    content = match.group(2)
+    # Если строка содержит текст после цифр - делаем заголовком
+    # Проверяем, что заголовок осмысленный (не просто точка или пробел)
+    if content.strip() and not _RE_JUNK.match(content):
+        return f"# {content}"
+    # Если после цифр только мусор (например, "1. ."), строка удаляется
+    return ''
+
 def clean_text(text):
     """
     Очищает текст по расширенным правилам:
@@ -50,64 +154,36 @@ def clean_text(text):
     4. Удаляет пробелы.
     5. Форматирует заголовки.
     """
-    import re
     if not text:
         return ""
 
     # 1. Удаляем строки, начинающиеся с '## Источник:' (на случай, если они есть во входных данных)
-    text = re.sub(r'^## Источник:.*$', '', text, flags=re.MULTILINE)
+    text = _RE_SOURCE.sub('', text)
     
     # 2. Удаляем две и более точек '..' и заменяем одним пробелом (или просто удаляем)
     # По заданию: "Удаляет все последовательности..."
-    text = re.sub(r'\.{2,}', '', text)
+    text = _RE_DOTS.sub('', text)
     
     # Исправление кодировки (замена /uniXXXX на символы)
-    def replace_uni(match):
-        try:
-            return chr(int(match.group(1), 16))
-        except:
-            return match.group(0)
-    text = re.sub(r'/uni([0-9A-Fa-f]{4})', replace_uni, text)
+    text = _RE_UNI.sub(_replace_uni, text)
     
-    lines = text.split('\n')
-    cleaned_lines = []
-    
-    for line in lines:
-        # 4. Удаляет ведущие и завершающие пробелы
-        stripped_line = line.strip()
-        
-        # Пропускаем пустые строки
-        if not stripped_line:
-            continue
+    # 4. Удаляет ведущие и завершающие пробелы
+    text = "\n".join(line.strip() for line in text.split('\n'))
 
-        # 3. Удаляет все числа в конце строк (номера страниц)
-        stripped_line = re.sub(r'\s+\d+$', '', stripped_line)
-        stripped_line = stripped_line.strip()
-        
-        if not stripped_line:
-            continue
-            
-        # Удаляем мусорные строки, состоящие только из точек или символов #
-        if re.match(r'^[\.#\s]+$', stripped_line):
-             continue
-
-        # 5. Заменяет заголовки типа '8 1.4 Недостатки' на '# Недостатки'
-        match_header = re.match(r'^(\d+(?:[\.\s]\d+)*)\s+(.*)$', stripped_line)
-        if match_header:
-            content = match_header.group(2)
-            # Если строка содержит текст после цифр - делаем заголовком
-            # Проверяем, что заголовок осмысленный (не просто точка или пробел)
-            if content.strip() and not re.match(r'^[\.#\s]+$', content):
-                stripped_line = f"# {content}"
-            else:
-                 # Если после цифр только мусор, пропускаем или оставляем как текст без #
-                 # В данном случае лучше пропустить, если это просто "1. ."
-                 continue
+    # Дальше правила применяются к строкам всего буфера сразу (re.MULTILINE),
+    # без регулярного выражения на каждую строку в цикле Python
 
-        cleaned_lines.append(stripped_line)
-    
-    # Объединяем через перевод строки, чтобы сохранить структуру
-    full_text = "\n".join(cleaned_lines)
+    # 3. Удаляет все числа в конце строк (номера страниц)
+    text = _RE_TAIL_NUM_LINES.sub('', text)
+
+    # 5. Заменяет заголовки типа '8 1.4 Недостатки' на '# Недостатки'
+    text = _RE_HEADER_LINES.sub(_replace_header, text)
+
+    # Удаляем мусорные строки, состоящие только из точек или символов #
+    text = _RE_JUNK_LINES.sub('', text)
+
+    # Пропускаем пустые строки: схлопываем переводы строк, чтобы сохранить структуру
+    full_text = _RE_BLANK_LINES.sub('\n', text).strip('\n')
     
     return full_text
 
@@ -115,16 +191,47 @@ def process_text(text):
     """
     Разбивает текст на куски по 1000 символов с перекрытием 200.
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-        is_separator_regex=False,
-    )
-    
-    chunks = text_splitter.split_text(text)
+    chunks = _SPLITTER.split_text(text)
     return chunks
 
+def quantize_embeddings(embeddings):
+    """
+    Симметричное int8-квантование эмбеддингов с масштабом на каждый вектор.
+    Исходный вектор восстанавливается как embedding * embedding_scale.
+    Возвращает (списки int, список масштабов).
+    """
+    scales = np.abs(embeddings).max(axis=1, keepdims=True) / EMBEDDING_INT8_MAX
+    # Нулевой вектор квантуется в нули с любым масштабом
+    scales[scales == 0] = 1.0
+    quantized = np.round(embeddings / scales).astype(np.int8)
+    return quantized.tolist(), scales[:, 0].tolist()
+
+@lru_cache(maxsize=1)
+def get_model():
+    """Модель эмбеддингов (загружается один раз на процесс)."""
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+def open_embedding_cache(path=EMBEDDING_CACHE_PATH):
+    """
+    Открывает SQLite-кэш документов: хеш содержимого -> чанки и
+    квантованные эмбеддинги (JSON). Неизмененные файлы при повторном
+    запуске не очищаются, не разбиваются и не кодируются моделью заново.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS documents ("
+        "hash TEXT PRIMARY KEY, chunks BLOB, embeddings BLOB, scales BLOB)"
+    )
+    return conn
+
+def content_hash(content):
+    """Ключ кэша: BLAKE2b от версии кэша, модели и текста документа."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(EMBEDDING_CACHE_VERSION + b"\0" + EMBEDDING_MODEL.encode("utf-8") + b"\0")
+    digest.update(content.encode("utf-8"))
+    return digest.hexdigest()
+
 def main():
     """
     Основная функция скрипта.
@@ -134,14 +241,6 @@ def main():
     output_json = "dataset_with_embeddings.json"
     
     print("Начало обработки...")
-    
-    # Инициализация модели для эмбеддингов
-    print("Загрузка модели эмбеддингов...")
-    try:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-    except Exception as e:
-        print(f"Ошибка загрузки модели: {e}")
-        return
 
     # 1. Считываем файлы
     docs = read_files(input_folder)
@@ -150,48 +249,109 @@ def main():
         print("Файлы для обработки не найдены.")
         return
 
-    all_chunks_md = []
-    all_chunks_data = []
+    texts = []
+    meta = []
+    # Квантованные эмбеддинги и масштабы по чанкам (None - еще не посчитаны)
+    quantized = []
+    scales = []
+    # Документы без записи в кэше: (хеш, первый чанк, конец диапазона)
+    misses = []
+    cache = open_embedding_cache()
 
-    # 2. Обрабатываем каждый файл
-    chunk_global_id = 0
-    for filename, content in docs:
-        # Очистка
-        cleaned_content = clean_text(content)
-        
-        # Разбиение на чанки
-        chunks = process_text(cleaned_content)
-        
-        for i, chunk in enumerate(chunks):
-            chunk_global_id += 1
-            
-            # Генерация эмбеддинга
-            embedding = model.encode(chunk).tolist()
-            
-            # Формируем запись для Markdown
-            chunk_record_md = f"## Источник: {filename}, Чанк: {i+1}\n\n{chunk}\n\n---\n\n"
-            all_chunks_md.append(chunk_record_md)
+    # 2. Обрабатываем каждый файл: чанки сразу пишутся в Markdown
+    # и собираются для батчевого расчета эмбеддингов
+    with open(output_markdown, "w", encoding="utf-8") as md_file:
+        for filename, content in docs:
+            key = content_hash(content)
+            cached = cache.execute(
+                "SELECT chunks, embeddings, scales FROM documents WHERE hash = ?", (key,)
+            ).fetchone()
+            if cached:
+                chunks, doc_quantized, doc_scales = (_json_loads(value) for value in cached)
+            else:
+                # Очистка
+                cleaned_content = clean_text(content)
+                
+                # Разбиение на чанки
+                chunks = process_text(cleaned_content)
+                doc_quantized = doc_scales = [None] * len(chunks)
+                misses.append((key, len(texts), len(texts) + len(chunks)))
             
-            # Формируем запись для JSON
-            chunk_data = {
+            for i, chunk in enumerate(chunks):
+                # Запись для Markdown
+                md_file.write(f"## Источник: {filename}, Чанк: {i+1}\n\n{chunk}\n\n---\n\n")
+                
+                texts.append(chunk)
+                meta.append((filename, i + 1))
+            quantized.extend(doc_quantized)
+            scales.extend(doc_scales)
+
+    if not texts:
+        cache.close()
+        print("Текст для разбиения на чанки не найден.")
+        return
+
+    pending = [i for _, start, stop in misses for i in range(start, stop)]
+    if pending:
+        # Модель загружается только если есть чанки без эмбеддингов в кэше
+        print("Загрузка модели эмбеддингов...")
+        try:
+            model = get_model()
+        except Exception as e:
+            cache.close()
+            print(f"Ошибка загрузки модели: {e}")
+            return
+
+        # Одинаковые чанки (повторяющиеся колонтитулы и т.п.) кодируются один раз
+        unique_texts = {}
+        for i in pending:
+            unique_texts.setdefault(texts[i], len(unique_texts))
+
+        # Генерация эмбеддингов одним батчевым вызовом вместо model.encode на каждый чанк
+        embeddings = model.encode(
+            list(unique_texts),
+            batch_size=EMBEDDING_BATCH_SIZE,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        new_quantized, new_scales = quantize_embeddings(embeddings)
+        for i in pending:
+            position = unique_texts[texts[i]]
+            quantized[i] = new_quantized[position]
+            scales[i] = new_scales[position]
+
+    # Новые документы сохраняются в кэш
+    cache.executemany(
+        "INSERT OR REPLACE INTO documents (hash, chunks, embeddings, scales) VALUES (?, ?, ?, ?)",
+        [
+            (key, _json_dumps(texts[start:stop]), _json_dumps(quantized[start:stop]),
+             _json_dumps(scales[start:stop]))
+            for key, start, stop in misses
+        ],
+    )
+    cache.commit()
+    cache.close()
+
+    # 3. Сохраняем JSON: массив пишется по одной записи, без списка записей
+    # и без форматирования всего документа в памяти
+    with open(output_json, "wb") as f:
+        f.write(b"[")
+        for chunk_global_id, ((filename, chunk_index), chunk, embedding, scale) in enumerate(
+            zip(meta, texts, quantized, scales), start=1
+        ):
+            if chunk_global_id > 1:
+                f.write(b",\n")
+            f.write(_json_dumps({
                 "id": chunk_global_id,
                 "source": filename,
-                "chunk_index": i + 1,
+                "chunk_index": chunk_index,
                 "text": chunk,
-                "embedding": embedding
-            }
-            all_chunks_data.append(chunk_data)
-
-    # 3. Сохраняем результат
-    # Markdown
-    with open(output_markdown, "w", encoding="utf-8") as f:
-        f.writelines(all_chunks_md)
-    
-    # JSON
-    with open(output_json, "w", encoding="utf-8") as f:
-        json.dump(all_chunks_data, f, ensure_ascii=False, indent=2)
+                "embedding": embedding,
+                "embedding_scale": scale
+            }))
+        f.write(b"]\n")
         
-    print(f"Готово! Результат сохранен в '{output_markdown}' и '{output_json}'. Всего чанков: {len(all_chunks_data)}")
+    print(f"Готово! Результат сохранен в '{output_markdown}' и '{output_json}'. Всего чанков: {len(texts)}")
 
 if __name__ == "__main__":
     main()